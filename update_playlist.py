@@ -1,74 +1,168 @@
-import os, sys, subprocess, datetime, re, argparse, shutil
+import os, sys, subprocess, datetime, argparse, shutil, atexit, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 DEFAULT_LOG_FILE = "~/.cache/update_playlist/update_playlist.log"
 
-def log(msg, log_file=DEFAULT_LOG_FILE):
-    log_file=os.path.expanduser(log_file)
-    log_message = f"INFO: {msg}\n"
+# Supported media file extensions
+MEDIA_EXTENSIONS = frozenset({'mp3', 'mp4', 'mkv', 'avi', 'flac', 'wav', 'aac', 'ogg', 'opus'})
+MEDIA_SUFFIXES = tuple(f'.{ext}' for ext in MEDIA_EXTENSIONS)
+
+# Threads used to walk large folders with many subdirectories
+WALK_WORKERS = 4
+
+# Log files stay open for the whole run so each message is a buffered write
+# instead of an open/write/close round trip; they are flushed on error and exit
+log_handles = {}
+log_lock = threading.Lock()
+
+def write_log(log_message, log_file, flush=False):
     print(log_message, end="")
-    with open(log_file, "a") as f:
+    with log_lock:
+        f = log_handles.get(log_file)
+        if f is None:
+            f = log_handles[log_file] = open(os.path.expanduser(log_file), "a")
         f.write(log_message)
+        if flush:
+            f.flush()
+
+def flush_logs():
+    with log_lock:
+        for f in log_handles.values():
+            f.flush()
+
+@atexit.register
+def close_logs():
+    with log_lock:
+        for f in log_handles.values():
+            f.close()
+        log_handles.clear()
+
+def log(msg, log_file=DEFAULT_LOG_FILE):
+    log_message = f"INFO: {msg}\n"
+    write_log(log_message, log_file)
 
 def error(msg, log_file=DEFAULT_LOG_FILE):
-    log_file=os.path.expanduser(log_file)
     log_message = f"ERROR: {msg}\n"
-    print(log_message, end="")
-    with open(log_file, "a") as f:
-        f.write(log_message)
+    write_log(log_message, log_file, flush=True)
     sys.exit(1)
 
+def is_media_file(name):
+    return name.lower().endswith(MEDIA_SUFFIXES)
+
+def scan_media_dir(path):
+    media_names, subdirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # Symlinked directories are not followed, like os.walk does
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif is_media_file(entry.name):
+                    media_names.append(entry.name)
+    except OSError:
+        # Skip directories that can't be listed, like os.walk does
+        return [], []
+    return media_names, subdirs
+
+def walk_media_files(directories):
+    stack = list(reversed(directories))
+    while stack:
+        media_names, subdirs = scan_media_dir(stack.pop())
+        yield from media_names
+        # Pushed reversed so they are popped in listing order, like os.walk
+        stack.extend(reversed(subdirs))
+
+def iter_media_files(folder_path):
+    media_names, subdirs = scan_media_dir(folder_path)
+    yield from media_names
+
+    # Only fan out when there are enough subtrees to amortize the thread pool
+    if len(subdirs) > WALK_WORKERS:
+        with ThreadPoolExecutor(max_workers=WALK_WORKERS) as executor:
+            for media_files in executor.map(lambda d: list(walk_media_files([d])), subdirs):
+                yield from media_files
+    else:
+        yield from walk_media_files(subdirs)
+
+def find_spotdl_files(folder_path):
+    with os.scandir(folder_path) as entries:
+        return sorted(entry.path for entry in entries if entry.name.endswith(".spotdl"))
+
+def spotdl_env(base):
+    # Same environment `source e/bin/activate` would set up, without spawning a shell
+    venv = os.path.join(base, "e")
+    env = dict(os.environ, VIRTUAL_ENV=venv)
+    env["PATH"] = os.path.join(venv, "bin") + os.pathsep + env.get("PATH", "")
+    env.pop("PYTHONHOME", None)
+    return env
+
 def create_m3u_from_folder(folder_path, output_m3u):
-    # Supported media file extensions
-    media_extensions = {'.mp3', '.mp4', '.mkv', '.avi', '.flac', '.wav', '.aac', '.ogg', 'opus'}
-    
-    media_files = []
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            if any(file.lower().endswith(ext) for ext in media_extensions):
-                media_files.append(os.path.basename(file))
-    
-    # Write the playlist file
-    with open(output_m3u, 'w') as m3u_file:
-        for media_file in media_files:
-            m3u_file.write(media_file + '\n')
+    playlist = ''.join(f"{media_file}\n" for media_file in iter_media_files(folder_path))
+
+    # Write the playlist file, encoded once with the same codec the names were decoded with
+    with open(output_m3u, 'wb') as m3u_file:
+        m3u_file.write(os.fsencode(playlist))
     
     log(f'M3U playlist created: {output_m3u}')
 
-def update(config, skip_sync=False):
-    base, folders = config["base"][0], config["playlists"]
-    now = datetime.datetime.now()
-    log(f"Starting update {now.strftime("%Y-%m-%d %H:%M:%S")} of library located in {base}")
-    for folder in folders:
-        folder_path = os.path.join(base, folder)
+def update_folder(base, folder, skip_sync=False, threads=None):
+    folder_path = os.path.join(base, folder)
+    try:
         if not os.path.exists(folder_path):
             log(f"Folder does not exist: {folder_path}")
-            continue
-        
-        try:
-            if not skip_sync:
-                log(f"Processing folder {folder_path}...")
-                if any(File.endswith(".spotdl") for File in os.listdir(folder_path)):
-                    command = f"cd {folder_path} && source {os.path.join(base, "e/bin/activate")} && spotdl sync {folder_path}/*.spotdl --sync-without-deleting"
-                    log("Updating songs...")
-                    subprocess.run(command, shell=True, check=True, executable="/usr/bin/zsh")
-                else:
-                    log("Couldn\'t find a playlist to download, set it up with \"spotdl \'http://open.spotify.com/...\' --save-file myplaylist.spotdl\" first.")
-                
-            output_m3u = f"{os.path.basename(folder_path.rstrip('/'))}.m3u"
-            log(f"Updating playlist {output_m3u}")
-            path_output_m3u = os.path.join(folder_path, output_m3u)
-            create_m3u_from_folder(folder_path, path_output_m3u)
-
-        except subprocess.CalledProcessError as e:
-            log(f"'Couln't update {os.path.basename(folder_path)} correctly': {e}")
-            continue
+            return
+
+        if not skip_sync:
+            log(f"Processing folder {folder_path}...")
+            spotdl_files = find_spotdl_files(folder_path)
+            if spotdl_files:
+                command = [os.path.join(base, "e/bin/spotdl"), "sync", *spotdl_files, "--sync-without-deleting"]
+                if threads:
+                    command += ["--threads", str(threads)]
+                log(f"Updating songs in {folder_path}...")
+                # Get everything logged so far on disk before blocking on spotdl
+                flush_logs()
+                subprocess.run(command, check=True, cwd=folder_path, env=spotdl_env(base))
+            else:
+                log(f"Couldn\'t find a playlist to download in {folder_path}, set it up with \"spotdl \'http://open.spotify.com/...\' --save-file myplaylist.spotdl\" first.")
+            
+        output_m3u = f"{os.path.basename(folder_path.rstrip('/'))}.m3u"
+        log(f"Updating playlist {output_m3u}")
+        path_output_m3u = os.path.join(folder_path, output_m3u)
+        create_m3u_from_folder(folder_path, path_output_m3u)
+
+    except (subprocess.CalledProcessError, OSError) as e:
+        log(f"'Couln't update {os.path.basename(folder_path)} correctly': {e}")
+    finally:
+        # Flushed once per folder, failures included, so a killed run keeps its log
+        flush_logs()
+
+def update(config, skip_sync=False, jobs=1, threads=None):
+    base = config["base"][0]
+    # A folder listed twice would be synced and walked twice (concurrently with --jobs)
+    folders = list(dict.fromkeys(os.path.normpath(folder) for folder in config["playlists"]))
+    now = datetime.datetime.now()
+    log(f"Starting update {now.strftime("%Y-%m-%d %H:%M:%S")} of library located in {base}")
+    if jobs > 1 and len(folders) > 1:
+        # Folders are independent and the work is I/O bound (spotdl, disk walks)
+        with ThreadPoolExecutor(max_workers=min(jobs, len(folders))) as executor:
+            futures = [executor.submit(update_folder, base, folder, skip_sync, threads) for folder in folders]
+            for future in as_completed(futures):
+                future.result()
+    else:
+        for folder in folders:
+            update_folder(base, folder, skip_sync, threads)
 
     now = datetime.datetime.now()
     log(f"Update finished {now.strftime("%Y-%m-%d %H:%M:%S")}\n")
 
 def parse_config(path):
     config = {}
-    title_regex = re.compile(r"\[([a-zA-Z0-9]+)\]")
     with open(path, "r") as f:
         content = f.read()
 
@@ -79,9 +173,11 @@ def parse_config(path):
                 current_title = None
                 continue
 
-            result = title_regex.search(line)
-            if result is not None:
-                title = result.group(1)
+            # Section headers start with [name], e.g. [playlists]
+            title, sep = None, ''
+            if line[0] == '[':
+                title, sep, _ = line[1:].partition(']')
+            if sep and title.isascii() and title.isalnum():
                 current_title = title
                 if current_title not in config:
                     config[current_title] = []
@@ -115,15 +211,23 @@ def setup(config_file_path):
             config_file_path
         )
 
-def main(config_file="~/.config/update_playlist/playlist.config", skip_sync=False):
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def main(config_file="~/.config/update_playlist/playlist.config", skip_sync=False, jobs=1, threads=None):
     setup(config_file)
     config_file_path = os.path.expanduser(config_file)
     configuration = parse_config(config_file_path)
     
-    update(configuration, skip_sync)
+    update(configuration, skip_sync, jobs, threads)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--skip-sync', action='store_true')
+    parser.add_argument('--jobs', type=positive_int, default=1, help='number of playlists to update in parallel')
+    parser.add_argument('--threads', type=positive_int, help='number of songs spotdl downloads in parallel per playlist')
     args = parser.parse_args()
-    main(skip_sync=args.skip_sync)
+    main(skip_sync=args.skip_sync, jobs=args.jobs, threads=args.threads)